@@ -97,7 +97,8 @@ class PiranhaAgent:
         # Number of Chat interactions to have with the model
         n_samples = 5
         chat_interactions = [
-            PiranhaGPTChat(holes=prompt_holes) for _ in range(n_samples)
+            PiranhaGPTChat(holes=prompt_holes, validate_fn=self.is_valid_toml)
+            for _ in range(n_samples)
         ]
         first_round = chat_interactions[0].get_completion(n_samples=n_samples)
         for i, response in enumerate(first_round):
@@ -125,6 +126,24 @@ class PiranhaAgent:
             "GPT-4 failed to generate a rule. Try increasing the temperature."
         )
 
+    @staticmethod
+    def is_valid_toml(completion: str) -> bool:
+        """Cheap check that a completion contains a parseable TOML rule block.
+        Used by the chat's model-escalation ladder to decide whether a draft
+        from a cheaper model is worth keeping.
+
+        :param completion: str, Raw completion returned by the model.
+        :return: bool, True if the completion has a parseable ```toml``` block.
+        """
+        toml_blocks = re.findall(r"```toml(.*?)```", completion, re.DOTALL)
+        if not toml_blocks:
+            return False
+        try:
+            toml.loads(toml_blocks[0])
+            return True
+        except toml.TomlDecodeError:
+            return False
+
     def validate_rule(self, completion):
         # Define regex pattern for ```toml block
         pattern = r"```toml(.*?)```"
@@ -1,11 +1,27 @@
+import asyncio
+import functools
+import hashlib
+import json
 import logging
-import os
+import re
+import string
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional
 from logger_formatter import CustomFormatter
 import attr
 import openai
+import openai.api_requestor
+import orjson
+import tiktoken
 import time
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
 logger = logging.getLogger("PiranhaAgent")
 logger.setLevel(logging.DEBUG)
@@ -15,6 +31,103 @@ ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
+# Maximum OpenAI attempts before the transient error is re-raised to the caller.
+MAX_ATTEMPTS = 6
+
+# Matches full-line comments in the example rules.toml files.
+COMMENT_LINE_RE = re.compile(r"(?m)^#.*\n?")
+
+# Retry policy for transient OpenAI failures: exponential backoff with jitter,
+# capped attempts, and a warning logged before each sleep.
+openai_retry = retry(
+    retry=retry_if_exception_type(
+        (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIError)
+    ),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+
+
+@attr.s
+class RateLimiter:
+    """Token-bucket limiter for OpenAI requests.
+
+    Tracks a requests-per-minute and a tokens-per-minute bucket, refilled
+    continuously at rpm/60 and tpm/60 per second. Calling `acquire` before each
+    request throttles proactively instead of waiting for RateLimitError responses.
+    """
+
+    rpm = attr.ib(type=int, default=60)
+    tpm = attr.ib(type=int, default=90000)
+
+    def __attrs_post_init__(self):
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        """Returns how long to wait until one request and `tokens` tokens are available."""
+        self._refill()
+        if self._requests >= 1 and self._tokens >= tokens:
+            self._requests -= 1
+            self._tokens -= tokens
+            return 0.0
+        request_wait = (1 - self._requests) * 60 / self.rpm
+        token_wait = (tokens - self._tokens) * 60 / self.tpm
+        return max(request_wait, token_wait, 0.01)
+
+    def acquire(self, tokens: int):
+        """Blocks until the buckets can pay for one request of `tokens` tokens."""
+        while (wait := self._wait_time(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int):
+        """Async variant of `acquire` that yields to the event loop while waiting."""
+        while (wait := self._wait_time(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+rate_limiter = RateLimiter()
+
+
+class _OrjsonShim:
+    """Stand-in for the stdlib json module inside openai.api_requestor.
+
+    The SDK serializes request bodies itself with `json.dumps(...).encode()`
+    and parses responses with `json.loads`, so those are the only two entry
+    points that need covering. orjson returns bytes, hence the decode.
+    """
+
+    JSONDecodeError = orjson.JSONDecodeError
+
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
+
+def use_orjson_serialization():
+    """Makes the OpenAI SDK serialize request bodies with orjson.
+
+    The SDK builds every request body with json.dumps inside
+    openai.api_requestor; for the ~50KB prompts sent here orjson is several
+    times faster and allocates less. Swapping the module's json reference for
+    the shim covers both serialization and response parsing. Idempotent.
+    """
+    openai.api_requestor.json = _OrjsonShim
+
 
 @attr.s
 class PiranhaGPTChat:
@@ -115,6 +228,32 @@ at_most = 5
 ========================= Output =========================
     """
 
+    # Pre-parsed once at class creation so instantiating chats in a tight loop
+    # skips str.format's template parsing on every construction.
+    _INPUT_TEMPLATE = string.Template(input_template.replace("{", "${"))
+
+    batch_instruction = """
+========================= Batch Instructions =========================
+
+You will receive {n_tasks} independent tasks, delimited by "===== TASK i =====" markers.
+Solve each task separately, wrapping your complete answer for task i in a <task i> ... </task i> block.
+Inside every block follow the output format described above.
+    """
+
+    # Exact-match completion cache shared by all chats: sha256 of the request
+    # parameters -> completions. Re-sending an identical prompt (common while
+    # iterating on the same source/target pair) returns instantly instead of
+    # paying another OpenAI round-trip.
+    _cache = {}
+
+    # tiktoken encoders are expensive to build, so keep one per model name.
+    _ENCODERS = {}
+
+    # In-flight request coalescing for the async path: request hash -> Future.
+    # Byte-identical concurrent prompts (e.g. retries of the same holes under
+    # asyncio.gather) await the same future instead of issuing duplicate calls.
+    _inflight = {}
+
     holes = attr.ib(type=dict)
     messages = attr.ib(type=list, default=attr.Factory(list))
     temperature = attr.ib(
@@ -127,81 +266,326 @@ at_most = 5
     )
     model = attr.ib(
         default="gpt-4",
-        validator=attr.validators.in_(["gpt-4", "gpt-4-32k", "gpt-3.5-turbo"]),
+        validator=attr.validators.in_(
+            ["gpt-4", "gpt-4-32k", "gpt-3.5-turbo", "gpt-3.5-turbo-16k"]
+        ),
     )
+    max_history_turns = attr.ib(type=int, default=6)
+    # Validator used by the escalation ladder; takes the completion content and
+    # returns whether it is usable. When unset, responses use `model` directly.
+    validate_fn = attr.ib(default=None)
+
+    # Cheapest-first models tried by `get_model_response` when a `validate_fn`
+    # is provided. GPT-4 costs 10-20x GPT-3.5 per token, so drafts that pass
+    # validation on the cheap model never pay the GPT-4 price.
+    escalation = ["gpt-3.5-turbo-16k", "gpt-4"]
 
     def __attrs_post_init__(self):
-        examples = self._get_examples("../../src/cleanup_rules/java")
+        formatted = self._prefix(
+            "../../src/cleanup_rules/java"
+        ) + PiranhaGPTChat._INPUT_TEMPLATE.substitute(self.holes)
+
+        self._token_total = 0
+        # Index into `escalation` where the next validated turn starts; bumped
+        # when a cheaper model's draft fails validation so the chat stays on
+        # the escalated model for subsequent turns.
+        self._escalation_level = 0
+        self._append_message("user", formatted)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _prefix(cls, path_to_examples_rules: str) -> str:
+        """Returns the static `explanation + examples` prompt prefix.
+
+        The prefix is identical for every chat, so it is built once per path and
+        cached; only the small task-specific template tail is rebuilt per instance.
+        """
+        examples = cls._get_examples(path_to_examples_rules)
         examples = examples[: len(examples) // 2]
-
-        formatted = (
-            PiranhaGPTChat.explanation
-            + "\n"
-            + examples
-            + "\n"
-            + PiranhaGPTChat.input_template.format(**self.holes)
+        return cls.explanation + "\n" + examples + "\n"
+
+    @classmethod
+    def from_tasks(cls, holes_list: List[dict], **kwargs) -> "PiranhaGPTChat":
+        """Builds a single chat bundling several independent inference tasks.
+
+        Each task's `input_template` is rendered under a numbered delimiter so one
+        API call answers all of them, sharing the explanation/examples prefix and
+        avoiding one HTTP round-trip per task. Use `split_response` to recover the
+        per-task answers from the assistant message.
+
+        :param holes_list: list, One `holes` dict per task.
+        :return: PiranhaGPTChat, Chat whose first message contains every task.
+        """
+        chat = cls(holes=holes_list[0], **kwargs)
+        tasks = "".join(
+            f"\n===== TASK {i} =====\n" + cls._INPUT_TEMPLATE.substitute(holes)
+            for i, holes in enumerate(holes_list, start=1)
+        )
+        chat.messages[0]["content"] = (
+            cls._prefix("../../src/cleanup_rules/java")
+            + cls.batch_instruction.format(n_tasks=len(holes_list))
+            + tasks
         )
+        chat._token_total = cls.count_tokens(chat.model, chat.messages[0]["content"])
+        return chat
 
-        self.messages.append({"role": "user", "content": formatted})
+    @staticmethod
+    def split_response(content: str) -> List[str]:
+        """Splits a batched assistant response into its per-task answers.
+
+        :param content: str, Assistant message produced for a `from_tasks` chat.
+        :return: list, Answer bodies ordered by task number.
+        """
+        blocks = re.findall(r"<task\s*(\d+)>(.*?)</task\s*\1>", content, re.DOTALL)
+        return [body.strip() for _, body in sorted(blocks, key=lambda b: int(b[0]))]
+
+    @classmethod
+    def count_tokens(cls, model: str, content: str) -> int:
+        """Counts the tokens of one message content, caching the encoder per model."""
+        if model not in cls._ENCODERS:
+            cls._ENCODERS[model] = tiktoken.encoding_for_model(model)
+        encoding = cls._ENCODERS[model]
+        # + 4 accounts for the per-message role framing tokens.
+        return len(encoding.encode(content)) + 4
+
+    def _append_message(self, role: str, content: str):
+        """Appends a message and updates the running token total incrementally."""
+        self.messages.append({"role": role, "content": content})
+        self._token_total += self.count_tokens(self.model, content)
 
     def append_system_message(self, system_message):
         """Add a GPT response to the internal messages"""
-        self.messages.append({"role": "system", "content": system_message})
+        self._append_message("system", system_message)
 
     def append_user_followup(self, followup_message):
         """Add a followup message from the user after GPT replies"""
-        self.messages.append({"role": "user", "content": followup_message})
+        self._append_message("user", followup_message)
 
-    def get_model_response(self):
+    def get_model_response(self, stream: bool = False):
         latest_message = self.messages[-1]
         if latest_message["role"] == "system":
             return latest_message["content"]
+        elif self.validate_fn is not None:
+            return self._get_validated_response()
+        elif stream:
+            content = "".join(self.get_completion_stream())
+            self.append_system_message(content)
+            return content
         else:
             completions = self.get_completion(n_samples=1)
             content = completions[0]
             self.append_system_message(content)
             return content
 
+    def _get_validated_response(self) -> str:
+        """Walks the escalation ladder cheapest-first, validating each draft.
+
+        A draft is accepted as soon as `validate_fn` passes; otherwise the same
+        request is re-issued with the next model. The last model's answer is
+        accepted unconditionally, and the chat stays on the escalated model for
+        subsequent turns.
+        """
+        for model in self.escalation[self._escalation_level :]:
+            self.model = model
+            content = self.get_completion(n_samples=1)[0]
+            if model == self.escalation[-1] or self.validate_fn(content):
+                break
+            self._escalation_level += 1
+            logger.debug(
+                "Draft from %s failed validation; escalating to the next model.", model
+            )
+        self.append_system_message(content)
+        return content
+
+    async def aget_model_response(self) -> str:
+        """Async equivalent of `get_model_response` for driving many chats
+        concurrently. Applies the same `validate_fn` escalation ladder as the
+        sync path; streaming is only available through `get_model_response`.
+        """
+        latest_message = self.messages[-1]
+        if latest_message["role"] == "system":
+            return latest_message["content"]
+        elif self.validate_fn is not None:
+            return await self._aget_validated_response()
+        else:
+            completions = await self.aget_completion(n_samples=1)
+            content = completions[0]
+            self.append_system_message(content)
+            return content
+
+    async def _aget_validated_response(self) -> str:
+        """Async twin of `_get_validated_response`, built on `aget_completion`."""
+        for model in self.escalation[self._escalation_level :]:
+            self.model = model
+            completions = await self.aget_completion(n_samples=1)
+            content = completions[0]
+            if model == self.escalation[-1] or self.validate_fn(content):
+                break
+            self._escalation_level += 1
+            logger.debug(
+                "Draft from %s failed validation; escalating to the next model.", model
+            )
+        self.append_system_message(content)
+        return content
+
+    def _cache_key(self, n_samples: int) -> str:
+        request = {
+            "m": self.model,
+            "t": self.temperature,
+            "n": n_samples,
+            "msgs": self.messages,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def _compact_messages(self):
+        """Caps the history resent with every request.
+
+        Each refinement round appends two messages and every request resends the
+        whole conversation, so input tokens grow quadratically with the number of
+        turns. Keep the first message (explanation, examples and task) plus the
+        last `2 * max_history_turns` entries and drop the middle.
+        """
+        window = 2 * self.max_history_turns
+        if len(self.messages) > window + 1:
+            self.messages = [self.messages[0]] + self.messages[-window:]
+            self._token_total = sum(
+                self.count_tokens(self.model, message["content"])
+                for message in self.messages
+            )
+
+    def _estimate_tokens(self) -> int:
+        """Estimates the input tokens of the next request, for proactive throttling.
+
+        The total is maintained incrementally as messages are appended, so this
+        costs O(1) instead of re-tokenizing the whole history per request.
+        """
+        return self._token_total
+
+    async def aget_completion(self, n_samples: int = 1) -> Optional[List[str]]:
+        self._compact_messages()
+        key = self._cache_key(n_samples)
+        if key in PiranhaGPTChat._cache:
+            logger.debug("Completion cache hit; skipping OpenAI call.")
+            return PiranhaGPTChat._cache[key]
+        if key in PiranhaGPTChat._inflight:
+            logger.debug("Identical request already in flight; sharing its result.")
+            return await asyncio.shield(PiranhaGPTChat._inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        PiranhaGPTChat._inflight[key] = future
+        try:
+            completions = await self._acreate_completion(key, n_samples)
+            future.set_result(completions)
+            return completions
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception retrieved: with no duplicate waiter attached,
+            # asyncio would otherwise log "Future exception was never
+            # retrieved" when the future is garbage collected.
+            future.exception()
+            raise
+        finally:
+            PiranhaGPTChat._inflight.pop(key, None)
+
+    @openai_retry
+    async def _acreate_completion(self, key: str, n_samples: int) -> List[str]:
+        logger.debug("Attempting to get completion from GPT.")
+        await rate_limiter.aacquire(self._estimate_tokens())
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=self.messages,
+            temperature=self.temperature,  # this is the degree of randomness of the model's output
+            n=n_samples,
+        )
+        completions = [
+            response.choices[i].message.content for i in range(len(response.choices))
+        ]
+        PiranhaGPTChat._cache[key] = completions
+        return completions
+
+    @openai_retry
     def get_completion(self, n_samples: int = 1) -> Optional[List[str]]:
-        while True:
-            try:
-                logger.debug("Attempting to get completion from GPT.")
-                print(f"{self.messages[-1]['content']}\n")
-                response = openai.ChatCompletion.create(
-                    model=self.model,
-                    messages=self.messages,
-                    temperature=self.temperature,  # this is the degree of randomness of the model's output
-                    n=n_samples,
-                )
-                return [
-                    response.choices[i].message.content
-                    for i in range(len(response.choices))
-                ]
-            except (
-                openai.error.RateLimitError,
-                openai.error.Timeout,
-                openai.error.APIError,
-            ) as e:
-                logger.error(e)
-                sleep_time = 10
-                print(f"Rate limit reached. Sleeping for {sleep_time}s.")
-                time.sleep(sleep_time)
+        self._compact_messages()
+        key = self._cache_key(n_samples)
+        if key in PiranhaGPTChat._cache:
+            logger.debug("Completion cache hit; skipping OpenAI call.")
+            return PiranhaGPTChat._cache[key]
+        logger.debug("Attempting to get completion from GPT.")
+        logger.debug("prompt: %s", self.messages[-1]["content"])
+        rate_limiter.acquire(self._estimate_tokens())
+        response = openai.ChatCompletion.create(
+            model=self.model,
+            messages=self.messages,
+            temperature=self.temperature,  # this is the degree of randomness of the model's output
+            n=n_samples,
+        )
+        completions = [
+            response.choices[i].message.content for i in range(len(response.choices))
+        ]
+        PiranhaGPTChat._cache[key] = completions
+        return completions
+
+    @openai_retry
+    def _create_stream(self):
+        logger.debug("Attempting to stream completion from GPT.")
+        rate_limiter.acquire(self._estimate_tokens())
+        return openai.ChatCompletion.create(
+            model=self.model,
+            messages=self.messages,
+            temperature=self.temperature,  # this is the degree of randomness of the model's output
+            n=1,
+            stream=True,
+        )
+
+    def get_completion_stream(self):
+        """Streams a single completion, yielding content chunks as they arrive.
+
+        Lets downstream TOML parsing/validation start before the final token and
+        allows aborting a malformed response early instead of paying for all of
+        its output tokens. Callers that want the chat history updated should go
+        through `get_model_response(stream=True)`, which accumulates the chunks.
+        """
+        self._compact_messages()
+        for chunk in self._create_stream():
+            yield chunk.choices[0].delta.get("content", "")
+
+    @staticmethod
+    async def gather_model_responses(
+        chats: List["PiranhaGPTChat"], concurrency: int = 8
+    ) -> List[str]:
+        """Drives multiple chats concurrently, overlapping the network round-trips.
+        A semaphore bounds the number of in-flight OpenAI requests to respect rate limits.
+
+        :param chats: list, Chats whose next model response should be fetched.
+        :param concurrency: int, Maximum number of concurrent OpenAI requests.
+        :return: list, Model responses in the same order as `chats`.
+        """
+        use_orjson_serialization()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded_response(chat: "PiranhaGPTChat") -> str:
+            async with semaphore:
+                return await chat.aget_model_response()
+
+        return list(await asyncio.gather(*(bounded_response(chat) for chat in chats)))
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _get_examples(path_to_examples_rules):
-        task_examples = ""
-        for root, dirs, files in os.walk(path_to_examples_rules):
-            for file in files:
-                if file.endswith("rules.toml"):
-                    file_name = os.path.join(root, file)
-                    file_contents = Path(file_name).read_text()
-                    file_contents = "\n".join(
-                        [
-                            line
-                            for line in file_contents.split("\n")
-                            if not line.startswith("#")
-                        ]
-                    )
-                    task_examples += f"<file_name_start> {file_name} <file_name_end>\n"
-                    task_examples += f"```toml {file_contents}```\n"
-        return task_examples
+        examples_root = Path(path_to_examples_rules)
+        file_paths = [
+            file_path
+            for file_path in examples_root.rglob("rules.toml")
+            if not any(
+                part.startswith(".")
+                for part in file_path.relative_to(examples_root).parts
+            )
+        ]
+        # The read syscalls release the GIL, so overlapping them hides disk latency.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(Path.read_text, file_paths))
+        parts = []
+        for file_path, file_contents in zip(file_paths, contents):
+            file_contents = COMMENT_LINE_RE.sub("", file_contents)
+            parts.append(f"<file_name_start> {file_path} <file_name_end>\n")
+            parts.append(f"```toml {file_contents}```\n")
+        return "".join(parts)